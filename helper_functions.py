@@ -1,6 +1,10 @@
 import numpy as np
 import pandas as pd
+import polars as pl
+from numba import njit, prange
 import geopandas as gpd
+import pyogrio
+import shapely
 import country_converter as coco
 from bokeh.io import output_notebook, show, output_file
 from bokeh.plotting import figure
@@ -8,7 +12,39 @@ from bokeh.models import GeoJSONDataSource, LinearColorMapper, ColorBar, BasicTi
 from bokeh.palettes import brewer
 from bokeh.embed import file_html
 from bokeh.resources import CDN
-import json
+import functools
+
+
+PSYCHOMETRICS = ['E', 'A', 'C', 'N', 'O']
+QUESTIONNAIRE_PREFIXES = ['EXT', 'AGR', 'CSN', 'EST', 'OPN']
+QUESTIONNAIRE_COLS = [prefix + str(i) for prefix in QUESTIONNAIRE_PREFIXES for i in range(1, 11)]
+
+# sign of each question in its score, one row per psychometric, see big-five-personality-test.pdf
+SCORING_SIGNS = np.array([
+    [+1, -1, +1, -1, +1, -1, +1, -1, +1, -1],  # E
+    [-1, +1, -1, +1, -1, +1, -1, +1, +1, +1],  # A
+    [+1, -1, +1, -1, +1, -1, +1, -1, +1, +1],  # C
+    [-1, +1, -1, +1, -1, -1, -1, -1, -1, -1],  # N
+    [+1, -1, +1, -1, +1, -1, +1, +1, +1, +1],  # O
+], dtype=np.int8)
+SCORING_BIAS = np.array([20, 14, 14, 38, 8], dtype=np.int16)
+
+
+def load_compact(path, sep='\t'):
+    """
+    Reads the questionnaire csv, storing the answer columns as 1 byte integers instead of the default
+    8 byte ones. Missing answers are kept as <NA>.
+
+    Arguments:
+        path {str} -- path to the csv file, ie: 'data-final.csv'
+
+    Keyword Arguments:
+        sep {str} -- the column separator of the file (default: {'\\t'})
+
+    Returns:
+        dataframe {pandas.dataframe} -- the loaded dataframe
+    """
+    return pd.read_csv(path, sep=sep, dtype={c: 'Int8' for c in QUESTIONNAIRE_COLS})
 
 
 def remove_outliers(dataframe, column_names, low = 5, high = 95):
@@ -28,14 +64,33 @@ def remove_outliers(dataframe, column_names, low = 5, high = 95):
     """ 
 
 
-    for column_name in column_names:
-        vlow,vhigh = np.percentile(dataframe[column_name].values,  q=[low,high])
-        out_df = dataframe[(dataframe[column_name] > vlow) & (dataframe[column_name] < vhigh)]
+    values = dataframe[column_names].to_numpy()
+    # percentiles of every column in one call, each of shape (len(column_names),)
+    vlow, vhigh = np.percentile(values, q=[low, high], axis=0)
+    # a row is kept only if it is within the thresholds for all the columns
+    mask = ((values > vlow) & (values < vhigh)).all(axis=1)
+    out_df = dataframe.loc[mask]
 
-    print("removed {} % of the rows".format(round(100*(dataframe.shape[0]-out_df.shape[0])/dataframe.shape[0]),decimals=4))
+    removed = 100 * (1 - out_df.shape[0] / dataframe.shape[0])
+    print("removed {:.4f} % of the rows".format(removed))
     return out_df
 
 
+@njit(parallel=True, cache=True)
+def _score_psychometrics(X, signs, bias, out):
+    """
+    Scores each row of the (n, 50) answers array X into the (n, 5) out array, in a single parallel
+    pass over the rows. Question j of trait k is column 10*k + j of X.
+    """
+    n_traits, n_questions = signs.shape
+    for i in prange(X.shape[0]):
+        for k in range(n_traits):
+            total = bias[k] + signs[k, 0] * X[i, n_questions * k]
+            for j in range(1, n_questions):
+                total += signs[k, j] * X[i, n_questions * k + j]
+            out[i, k] = total
+
+
 def compute_psychometrics(dataframe):
     """
     Compute the psychometrics for:
@@ -52,38 +107,21 @@ def compute_psychometrics(dataframe):
         dataframe {pandas.DataFrame} -- The pandas dataframe with at least the columns for the 
                                         psychometrics.
     Returns:
-        dataframe -- the resulting pandas dataframe with the columns of E,A,C,N,O  scored.
+        dataframe -- the resulting pandas dataframe with the columns of E,A,C,N,O  scored. The scores are
+                     int16, or float32 with NaN scores for rows with missing answers if any answer is missing.
 
     """
-    dataframe['E'] = ( 20 + dataframe['EXT1'] - dataframe['EXT2'] 
-                    + dataframe['EXT3'] - dataframe['EXT4']
-                    + dataframe['EXT5'] - dataframe['EXT6']
-                    + dataframe['EXT7'] - dataframe['EXT8'] 
-                    + dataframe['EXT9'] - dataframe['EXT10'])
-    
-    dataframe['A'] = ( 14 - dataframe['AGR1'] + dataframe['AGR2']
-                   -dataframe['AGR3'] + dataframe['AGR4']
-                   -dataframe['AGR5'] + dataframe['AGR6']
-                   -dataframe['AGR7'] + dataframe['AGR8']
-                   +dataframe['AGR9'] + dataframe['AGR10'] )  
-    
-    dataframe['C'] = ( 14 + dataframe['CSN1'] - dataframe['CSN2']
-                   + dataframe['CSN3'] - dataframe['CSN4'] 
-                   + dataframe['CSN5'] - dataframe['CSN6']
-                   + dataframe['CSN7'] - dataframe['CSN8']
-                   + dataframe['CSN9'] + dataframe['CSN10'] )
-    
-    dataframe['N'] = (38 - dataframe['EST1'] + dataframe['EST2']
-                     - dataframe['EST3'] + dataframe['EST4']
-                      - dataframe['EST5'] - dataframe['EST6']
-                      - dataframe['EST7'] - dataframe['EST8']
-                      - dataframe['EST9'] - dataframe['EST10'] )
-    
-    dataframe['O'] = (8 + dataframe['OPN1'] - dataframe['OPN1']
-                     + dataframe['OPN1'] - dataframe['OPN1']
-                     + dataframe['OPN1'] - dataframe['OPN1']
-                     + dataframe['OPN1'] + dataframe['OPN1']
-                     + dataframe['OPN1'] + dataframe['OPN1'])
+    questions = dataframe[QUESTIONNAIRE_COLS]
+    if questions.isna().to_numpy().any():
+        # missing answers propagate to NaN scores
+        X = questions.to_numpy(dtype=np.float32, na_value=np.nan)
+    else:
+        # answers are 1-5, with 0 marking an unanswered question, so the scores fit in an int16 accumulator
+        X = questions.to_numpy(dtype=np.int16)
+    X = np.ascontiguousarray(X)
+    scores = np.empty((X.shape[0], len(PSYCHOMETRICS)), dtype=X.dtype)
+    _score_psychometrics(X, SCORING_SIGNS, SCORING_BIAS, scores)
+    dataframe[PSYCHOMETRICS] = scores
     return dataframe
 
 
@@ -102,13 +140,32 @@ def filter_countries(dataframe, minvalues = 100):
         dataframe {pandas.dataframe} -- the dataframe with entries removed for countries with not enough values
     """    
 
-    country_list=dataframe['country'].value_counts()
-    country_list=country_list[country_list.values>100]
-    country_list=country_list.index.to_list()
-    country_list.remove('NONE')
-    filtered_country=dataframe[dataframe['country'].isin(country_list)]
+    counts = dataframe.groupby('country')['country'].transform('size')
+    mask = (counts >= minvalues) & (dataframe['country'] != 'NONE')
+
+    return dataframe.loc[mask]
+
+
+@functools.lru_cache(maxsize=1)
+def _read_shapefile(shapefile):
+    """
+    Reads the country name, country code and geometry columns of the shapefile, without Antarctica.
+    The result is cached, callers should copy it before modifying it.
+    """
+    columns = ['ADMIN', 'ADM0_A3']
+    # pyogrio reads the features in bulk, only the requested columns are parsed and Antarctica
+    # is filtered out by OGR before it is read
+    return pyogrio.read_dataframe(shapefile, columns=columns,
+                                  where="ADMIN <> 'Antarctica'")[columns + ['geometry']]
+
 
-    return filtered_country
+@functools.lru_cache(maxsize=1)
+def _iso3_to_iso2(codes):
+    """
+    Converts a tuple of ISO3 country codes to a list of ISO2 codes. The result is cached, since the
+    conversion is slow and the shapefile codes do not change between calls.
+    """
+    return coco.convert(list(codes), to='ISO2')
 
 
 def country_averages(dataframe):
@@ -126,62 +183,64 @@ def country_averages(dataframe):
         the geometric shape of country on a map, and country labels.
                                  
     """    
-    Edf=dataframe.groupby(by='country').mean()['E']
-    Adf=dataframe.groupby(by='country').mean()['A']
-    Cdf=dataframe.groupby(by='country').mean()['C']
-    Ndf=dataframe.groupby(by='country').mean()['N']
-    Odf=dataframe.groupby(by='country').mean()['O']
+    # one parallel groupby pass for all the psychometric columns, grouped on the category codes
+    country = dataframe['country'].astype('category')
+    country_means = (pl.from_pandas(dataframe[PSYCHOMETRICS].assign(country=country))
+                       .lazy()
+                       .group_by('country')
+                       .agg([pl.col(c).mean() for c in PSYCHOMETRICS])
+                       .with_columns(pl.col('country').cast(pl.Utf8))
+                       .rename({'country': 'country_code'})
+                       .collect()
+                       .to_pandas())
 
     shapefile = 'ne_110_admin_0_countries/ne_110m_admin_0_countries.shp'
-    gdf = gpd.read_file(shapefile)[['ADMIN', 'ADM0_A3', 'geometry']]
+    gdf = _read_shapefile(shapefile).copy()
     gdf.columns=['country','country_code' , 'geometry']
-    gdf.drop(gdf[gdf['country'] =='Antarctica'].index)
-    gdf['country_code']=coco.convert(gdf['country_code'].to_list(), to= 'ISO2')
-    # merge the gdf with the group by for countries
-    merged=gdf.merge(Edf, left_on='country_code', right_on='country', how='outer')
-    merged=merged.merge(Adf, left_on='country_code', right_on='country',how='outer')
-    merged=merged.merge(Cdf, left_on='country_code', right_on='country',how='outer')
-    merged=merged.merge(Ndf, left_on='country_code', right_on='country',how='outer')
-    merged=merged.merge(Odf, left_on='country_code', right_on='country',how='outer')
-    merged.dropna(subset=['country'], inplace=True)
-    merged['E'].fillna(-100, inplace= True)
-    merged['A'].fillna(-100, inplace= True)
-    merged['C'].fillna(-100, inplace= True)
-    merged['N'].fillna(-100, inplace= True)
-    merged['O'].fillna(-100, inplace= True)
+    gdf['country_code'] = _iso3_to_iso2(tuple(gdf['country_code'].tolist()))
+    # merge the gdf with the group by for countries, a pandas left merge keeps the gdf row order
+    merged = gdf.merge(country_means, on='country_code', how='left')
+    merged[PSYCHOMETRICS] = merged[PSYCHOMETRICS].fillna(-100)
 
     #merged.to_csv('country_averages.csv')
 
     return merged
 
-def plot_map(dataframe, column):
+def make_geosource(dataframe):
+    """
+    Serializes the country averages to a bokeh GeoJSONDataSource. Build it once and pass it to
+    plot_map for each psychometric, the geometry is the same for all of them.
+
+    Arguments:
+        dataframe {geopandas.dataframe} -- the output of country_averages
+
+    Returns:
+        {bokeh.models.GeoJSONDataSource} -- the data source with the country, psychometric and geometry columns
+    """
+    # keep only the plotted columns, simplify the outlines and round the coordinates to ~1 m
+    # to shrink the GeoJSON handed to bokeh
+    geometry = dataframe.geometry.simplify(0.05, preserve_topology=True)
+    geometry = gpd.GeoSeries(shapely.set_precision(geometry.values, 1e-5),
+                             index=dataframe.index, crs=dataframe.crs)
+    json_data = gpd.GeoDataFrame(dataframe[['country'] + PSYCHOMETRICS], geometry=geometry).to_json()
+    return GeoJSONDataSource(geojson= json_data)
+
+
+def plot_map(geosource, column, dataframe):
 
-    merged_json=json.loads(dataframe.to_json())
-    
-    json_data=json.dumps(merged_json)
-    geosource = GeoJSONDataSource(geojson= json_data)
-    
     palette= brewer['RdYlBu'][10]
     
-    vals=dataframe[dataframe[column]>-50][column].values
-    #vals=vals - np.mean(vals)
-    vmin=np.round(np.min(vals), decimals = 1)
-    r= np.max(vals) - np.min(vals)
+    # countries without values are filled with -100, leave them out of the colour range
+    vals = dataframe[column].to_numpy()
+    vals = vals[vals > -50]
+    vals_min, vals_max = vals.min(), vals.max()
+    vmin=np.round(vals_min, decimals = 1)
+    r= vals_max - vals_min
     color_mapper = LinearColorMapper (palette= palette, low = vmin-5,
                                     high= vmin + r)
-    tick_labels= {'no values': str(np.round((vmin-5),decimals=1)),
-                '0': str(np.round(vmin,decimals=1)),
-                '10': str(np.round((vmin + 0.1 * r),decimals=1)),
-                '20': str(np.round((vmin + 0.2 * r),decimals=1)),
-                '30': str(np.round((vmin + 0.3 * r),decimals=1)),
-                '40': str(np.round((vmin + 0.4 * r),decimals=1)),
-                '50': str(np.round((vmin + 0.5 * r),decimals=1)),
-                '60': str(np.round((vmin + 0.6 * r),decimals=1)),
-                '70': str(np.round((vmin + 0.7 * r),decimals=1)),
-                '80': str(np.round((vmin + 0.8 * r),decimals=1)),
-                '90': str(np.round((vmin + 0.9 * r),decimals=1)),
-                '100': str(np.round((vmin + r),decimals=1))
-                }
+    ticks = np.round(vmin + np.linspace(0, 1, 11) * r, decimals=1)
+    tick_labels = {str(10 * i): str(tick) for i, tick in enumerate(ticks)}
+    tick_labels['no values'] = str(np.round((vmin-5),decimals=1))
     color_bar = ColorBar(color_mapper= color_mapper, 
                         label_standoff=10, width = 500, height = 20,
                         border_line_color = None, location = (0,0), 